@@ -1,7 +1,8 @@
 from __future__ import annotations
 
+import asyncio
+from collections import deque
 from datetime import datetime, timezone
-import json
 import logging
 import socket
 import time
@@ -9,8 +10,10 @@ from typing import Any, Literal, Optional
 from urllib.parse import urlsplit
 
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field, HttpUrl
 
 
@@ -55,9 +58,46 @@ class AppState(BaseModel):
     inbound_attempts: list[InboundAttempt]
 
 
-app = FastAPI(title="Fake Third Party Demo", version="1.0.0")
+class TokenBucket:
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+app = FastAPI(
+    title="Fake Third Party Demo",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
 logger = logging.getLogger("fake_third_party_demo")
 FRONTEND_ORIGINS = {"http://localhost:5173", "http://127.0.0.1:5173"}
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 4
+DNS_CACHE_TTL = 300.0
+MAX_TRACKED_BODY_BYTES = 65536
+WEBHOOK_RATE_PER_SECOND = 20.0
+WEBHOOK_BURST = 40
+WEBHOOK_MAX_TRIES = 3
+WEBHOOK_RETRY_BACKOFF = 0.1
+WEBHOOK_PROVIDER = "hubspot"
+WEBHOOK_MODEL = "customer"
+# The serialized payload with an empty external_ids list, split around where the id goes.
+WEBHOOK_BODY_SUFFIX = b"]}"
+WEBHOOK_BODY_PREFIX = orjson.dumps(
+    {"provider": WEBHOOK_PROVIDER, "model": WEBHOOK_MODEL, "external_ids": []}
+)[: -len(WEBHOOK_BODY_SUFFIX)]
 
 if not logger.handlers:
     logging.basicConfig(
@@ -74,40 +114,91 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def open_http_client() -> None:
+    app.state.http_client = httpx.AsyncClient(
+        timeout=1.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+
+
+@app.on_event("startup")
+async def start_webhook_workers() -> None:
+    app.state.webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    app.state.webhook_workers = [
+        asyncio.create_task(webhook_worker(app.state.webhook_queue))
+        for _ in range(WEBHOOK_WORKERS)
+    ]
+
+
+@app.on_event("shutdown")
+async def stop_webhook_workers() -> None:
+    for worker in app.state.webhook_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.webhook_workers, return_exceptions=True)
+
+
+@app.on_event("shutdown")
+async def close_http_client() -> None:
+    await app.state.http_client.aclose()
+
+
+def split_webhook_url(url: str) -> tuple[Optional[str], int]:
+    parsed = urlsplit(url)
+    return parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80)
+
+
 SEED_CUSTOMERS: list[Customer] = [
     Customer(id="hs-001", archived=False, payment_term="Net 30"),
     Customer(id="hs-002", archived=False, payment_term=None),
     Customer(id="hs-003", archived=True, payment_term=None),
 ]
 
+# Seeds are listed in id order and ids never change, so dict order is id order.
 customers_by_id: dict[str, Customer] = {customer.id: customer for customer in SEED_CUSTOMERS}
 webhook_url: Optional[str] = "http://localhost:8001/api/webhooks/third-party/sync"
-webhook_attempts: list[WebhookAttempt] = []
-inbound_attempts: list[InboundAttempt] = []
+webhook_target: tuple[Optional[str], int] = split_webhook_url(webhook_url)
+webhook_attempts: deque[WebhookAttempt] = deque(maxlen=30)
+inbound_attempts: deque[InboundAttempt] = deque(maxlen=50)
+dns_cache: dict[tuple[str, int], tuple[float, list[str]]] = {}
+webhook_buckets: dict[str, TokenBucket] = {}
 
 
 @app.middleware("http")
 async def track_inbound_attempts(request: Request, call_next):
-    global inbound_attempts
-
     origin = request.headers.get("origin")
     is_front_request = origin in FRONTEND_ORIGINS
     should_track = request.method in {"POST", "PUT", "PATCH"} and not is_front_request
     payload: Any = None
-    body = b""
 
     if should_track:
-        body = await request.body()
-        if body:
-            try:
-                payload = json.loads(body.decode("utf-8"))
-            except Exception:  # noqa: BLE001
-                payload = body.decode("utf-8", errors="replace")
-
-        async def receive() -> dict[str, Any]:
-            return {"type": "http.request", "body": body, "more_body": False}
-
-        request = Request(request.scope, receive)
+        content_type = request.headers.get("content-type", "")
+        declared_length = request.headers.get("content-length")
+        content_length = int(declared_length or 0)
+        # Without a Content-Length a chunked body's size is unknown, so never buffer it.
+        transfer_encoding = request.headers.get("transfer-encoding", "").lower()
+        is_unsized = declared_length is None and "chunked" in transfer_encoding
+        if (
+            is_unsized
+            or content_length > MAX_TRACKED_BODY_BYTES
+            or (content_type and not content_type.lower().startswith("application/json"))
+        ):
+            # Leave the body stream untouched; downstream reads it directly.
+            payload = {"_skipped": True, "size": content_length, "content_type": content_type}
+        else:
+            body = await request.body()
+            if body:
+                try:
+                    payload = orjson.loads(body)
+                except orjson.JSONDecodeError:
+                    payload = body.decode("utf-8", errors="replace")
+                else:
+                    request.state.cached_json = payload
+
+            async def receive() -> dict[str, Any]:
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            request = Request(request.scope, receive)
 
     status_code = 500
     success = False
@@ -123,65 +214,53 @@ async def track_inbound_attempts(request: Request, call_next):
         raise
     finally:
         if should_track:
-            inbound_attempts = (
-                inbound_attempts
-                + [
-                    InboundAttempt(
-                        at=datetime.now(timezone.utc),
-                        method=request.method,
-                        path=request.url.path,
-                        payload=payload,
-                        success=success,
-                        status_code=status_code,
-                        error=error,
-                    )
-                ]
-            )[-50:]
-
-
-async def notify_erp_webhook(customer: Customer) -> None:
-    global webhook_attempts
+            inbound_attempts.append(
+                InboundAttempt(
+                    at=datetime.now(timezone.utc),
+                    method=request.method,
+                    path=request.url.path,
+                    payload=payload,
+                    success=success,
+                    status_code=status_code,
+                    error=error,
+                )
+            )
+
 
+async def resolve_webhook_host(host: str, port: int) -> list[str]:
+    cached = dns_cache.get((host, port))
+    if cached and time.monotonic() - cached[0] < DNS_CACHE_TTL:
+        return cached[1]
+
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addresses = sorted({item[4][0] for item in infos})
+    dns_cache[(host, port)] = (time.monotonic(), addresses)
+    return addresses
+
+
+async def notify_erp_webhook(client: httpx.AsyncClient, customer: Customer) -> None:
     if not webhook_url:
         logger.warning("Webhook skipped: no webhook configured for customer_id=%s", customer.id)
-        webhook_attempts = (
-            webhook_attempts
-            + [
-                WebhookAttempt(
-                    at=datetime.now(timezone.utc),
-                    customer_id=customer.id,
-                    webhook_url=None,
-                    success=False,
-                    error="No webhook configured",
-                )
-            ]
-        )[-30:]
+        webhook_attempts.append(
+            WebhookAttempt(
+                at=datetime.now(timezone.utc),
+                customer_id=customer.id,
+                webhook_url=None,
+                success=False,
+                error="No webhook configured",
+            )
+        )
         return
 
-    payload = {
-        "provider": "hubspot",
-        "model": "customer",
-        "external_ids": [customer.id],
-    }
+    # Customer ids are not pattern-restricted, so let orjson quote and escape them.
+    body = WEBHOOK_BODY_PREFIX + orjson.dumps(customer.id) + WEBHOOK_BODY_SUFFIX
 
     try:
-        parsed = urlsplit(webhook_url)
-        host = parsed.hostname
-        scheme = parsed.scheme
-        port = parsed.port or (443 if scheme == "https" else 80)
-        if host:
+        host, port = webhook_target
+        if host and logger.isEnabledFor(logging.DEBUG):
             try:
-                addresses = sorted(
-                    {
-                        item[4][0]
-                        for item in socket.getaddrinfo(
-                            host,
-                            port,
-                            type=socket.SOCK_STREAM,
-                        )
-                    }
-                )
-                logger.info(
+                addresses = await resolve_webhook_host(host, port)
+                logger.debug(
                     "Webhook DNS resolved: host=%s port=%s addresses=%s",
                     host,
                     port,
@@ -196,40 +275,71 @@ async def notify_erp_webhook(customer: Customer) -> None:
                     exc,
                 )
 
-        start = time.monotonic()
-        logger.info(
-            "Sending webhook: customer_id=%s webhook_url=%r provider=%s model=%s external_ids=%s",
-            customer.id,
-            webhook_url,
-            payload["provider"],
-            payload["model"],
-            payload["external_ids"],
-        )
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(webhook_url, json=payload)
-        elapsed_ms = round((time.monotonic() - start) * 1000, 1)
-        response_excerpt = response.text[:200].replace("\n", "\\n")
-        logger.info(
-            "Webhook response: customer_id=%s status=%s success=%s elapsed_ms=%s body_excerpt=%r",
-            customer.id,
-            response.status_code,
-            response.is_success,
-            elapsed_ms,
-            response_excerpt,
-        )
-        webhook_attempts = (
-            webhook_attempts
-            + [
-                WebhookAttempt(
-                    at=datetime.now(timezone.utc),
-                    customer_id=customer.id,
-                    webhook_url=webhook_url,
-                    success=response.is_success,
-                    status_code=response.status_code,
-                    error=None if response.is_success else response.text[:200],
+        bucket: Optional[TokenBucket] = None
+        if host:
+            bucket = webhook_buckets.get(host)
+            if bucket is None:
+                bucket = webhook_buckets[host] = TokenBucket(WEBHOOK_RATE_PER_SECOND, WEBHOOK_BURST)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Sending webhook: customer_id=%s webhook_url=%r provider=%s model=%s external_ids=%s",
+                customer.id,
+                webhook_url,
+                WEBHOOK_PROVIDER,
+                WEBHOOK_MODEL,
+                [customer.id],
+            )
+        for attempt in range(1, WEBHOOK_MAX_TRIES + 1):
+            if bucket is not None:
+                await bucket.acquire()
+            start = time.monotonic()
+            try:
+                response = await client.post(
+                    webhook_url,
+                    content=body,
+                    headers={"content-type": "application/json"},
                 )
-            ]
-        )[-30:]
+            except (httpx.ConnectError, httpx.TimeoutException) as exc:
+                if attempt == WEBHOOK_MAX_TRIES:
+                    raise
+                retry_reason = str(exc) or type(exc).__name__
+            else:
+                if response.status_code < 500 or attempt == WEBHOOK_MAX_TRIES:
+                    break
+                retry_reason = f"status={response.status_code}"
+
+            backoff = WEBHOOK_RETRY_BACKOFF * 2 ** (attempt - 1)
+            logger.warning(
+                "Webhook retry: customer_id=%s attempt=%s backoff_s=%s reason=%s",
+                customer.id,
+                attempt,
+                backoff,
+                retry_reason,
+            )
+            await asyncio.sleep(backoff)
+
+        if logger.isEnabledFor(logging.INFO):
+            elapsed_ms = round((time.monotonic() - start) * 1000, 1)
+            response_excerpt = response.text[:200].replace("\n", "\\n")
+            logger.info(
+                "Webhook response: customer_id=%s status=%s success=%s elapsed_ms=%s body_excerpt=%r",
+                customer.id,
+                response.status_code,
+                response.is_success,
+                elapsed_ms,
+                response_excerpt,
+            )
+        webhook_attempts.append(
+            WebhookAttempt(
+                at=datetime.now(timezone.utc),
+                customer_id=customer.id,
+                webhook_url=webhook_url,
+                success=response.is_success,
+                status_code=response.status_code,
+                error=None if response.is_success else response.text[:200],
+            )
+        )
     except Exception as exc:  # noqa: BLE001
         logger.exception(
             "Webhook error: customer_id=%s webhook_url=%s error=%s",
@@ -237,18 +347,40 @@ async def notify_erp_webhook(customer: Customer) -> None:
             webhook_url,
             exc,
         )
-        webhook_attempts = (
-            webhook_attempts
-            + [
-                WebhookAttempt(
-                    at=datetime.now(timezone.utc),
-                    customer_id=customer.id,
-                    webhook_url=webhook_url,
-                    success=False,
-                    error=str(exc),
-                )
-            ]
-        )[-30:]
+        webhook_attempts.append(
+            WebhookAttempt(
+                at=datetime.now(timezone.utc),
+                customer_id=customer.id,
+                webhook_url=webhook_url,
+                success=False,
+                error=str(exc),
+            )
+        )
+
+
+async def webhook_worker(queue: asyncio.Queue[Customer]) -> None:
+    while True:
+        customer = await queue.get()
+        try:
+            await notify_erp_webhook(app.state.http_client, customer)
+        finally:
+            queue.task_done()
+
+
+def enqueue_erp_webhook(customer: Customer) -> None:
+    try:
+        app.state.webhook_queue.put_nowait(customer)
+    except asyncio.QueueFull:
+        logger.error("Webhook dropped: queue full for customer_id=%s", customer.id)
+        webhook_attempts.append(
+            WebhookAttempt(
+                at=datetime.now(timezone.utc),
+                customer_id=customer.id,
+                webhook_url=webhook_url,
+                success=False,
+                error="Webhook queue full",
+            )
+        )
 
 
 @app.get("/health")
@@ -257,12 +389,12 @@ def health() -> dict[str, str]:
 
 
 @app.get("/customers", response_model=list[Customer])
-def list_customers() -> list[Customer]:
-    return sorted(customers_by_id.values(), key=lambda c: c.id)
+async def list_customers() -> list[Customer]:
+    return list(customers_by_id.values())
 
 
 @app.get("/customers/{customer_id}", response_model=Customer)
-def get_customer(customer_id: str) -> Customer:
+async def get_customer(customer_id: str) -> Customer:
     customer = customers_by_id.get(customer_id)
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
@@ -277,20 +409,15 @@ async def update_customer_from_fake_third_party(
     if not existing:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    updated = existing.model_copy(
-        update={
-            "archived": payload.archived if payload.archived is not None else existing.archived,
-            "payment_term": (
-                payload.payment_term
-                if "payment_term" in payload.model_fields_set
-                else existing.payment_term
-            ),
-        }
-    )
-    customers_by_id[customer_id] = updated
+    # In-place updates are safe because every handler reading customers is async and runs on
+    # the event loop, so none can observe a half-applied PATCH.
+    if payload.archived is not None:
+        existing.archived = payload.archived
+    if "payment_term" in payload.model_fields_set:
+        existing.payment_term = payload.payment_term
 
-    await notify_erp_webhook(updated)
-    return updated
+    enqueue_erp_webhook(existing)
+    return existing
 
 
 @app.post("/customers/{customer_id}/call-erp", response_model=Customer)
@@ -299,23 +426,33 @@ async def call_erp_for_customer(customer_id: str) -> Customer:
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    await notify_erp_webhook(customer)
+    enqueue_erp_webhook(customer)
     return customer
 
 
 @app.post("/webhook/config")
-def set_webhook_config(payload: WebhookConfigRequest) -> dict[str, str]:
-    global webhook_url
+async def set_webhook_config(payload: WebhookConfigRequest) -> dict[str, str]:
+    global webhook_url, webhook_target
     webhook_url = str(payload.webhook_url).strip()
+    webhook_target = split_webhook_url(webhook_url)
     logger.info("Webhook configuration updated: webhook_url=%r", webhook_url)
     return {"webhook_url": webhook_url}
 
 
 @app.get("/state", response_model=AppState)
-def get_state() -> AppState:
-    return AppState(
-        webhook_url=webhook_url,
-        customers=sorted(customers_by_id.values(), key=lambda c: c.id),
-        webhook_attempts=list(reversed(webhook_attempts)),
-        inbound_attempts=list(reversed(inbound_attempts)),
+async def get_state() -> ORJSONResponse:
+    # Everything here is already validated; skip rebuilding an AppState for the response.
+    # The deques are iterated without a snapshot, which is only safe because this handler
+    # and every append run on the event loop; keep it async.
+    return ORJSONResponse(
+        {
+            "webhook_url": webhook_url,
+            "customers": [customer.model_dump(mode="json") for customer in customers_by_id.values()],
+            "webhook_attempts": [
+                attempt.model_dump(mode="json") for attempt in reversed(webhook_attempts)
+            ],
+            "inbound_attempts": [
+                attempt.model_dump(mode="json") for attempt in reversed(inbound_attempts)
+            ],
+        }
     )